@@ -0,0 +1,157 @@
+"""
+HTML Analysis Helpers
+
+Pure functions that turn a fetched product page into DSProduct fields.
+Kept free of FastAPI and database imports so the parsing process pool can
+import this module without opening a Mongo client or building the app.
+(Spawned workers also re-import the launching script, which is why the
+server is started from run.py rather than main.py.)
+"""
+
+import re
+import signal
+import json
+import math
+from typing import List, Optional
+from lxml import html as lxml_html
+from lxml.etree import ParserError
+
+# Basic HTML parser helpers
+TITLE_RE = re.compile(r"<title>(.*?)</title>", re.IGNORECASE | re.DOTALL)
+META_RE = re.compile(r'<meta[^>]*property=["\'](og:title|og:image)["\'][^>]*content=["\'](?P<val>[^"\']+)', re.IGNORECASE)
+PRICE_RE = re.compile(r"(?:price|amount)\"?[:=]\"?\s*([0-9]+(?:\.[0-9]{2})?)", re.IGNORECASE)
+
+CURRENCY_MAP = {"$": "USD", "€": "EUR", "£": "GBP"}
+CURRENCY_RE = re.compile("[$€£]")
+
+COMMON_SHOP_PLATFORMS = ["shopify", "woocommerce", "magento", "bigcommerce", "aliexpress", "amazon"]
+PLATFORM_RE = re.compile("|".join(map(re.escape, COMMON_SHOP_PLATFORMS)))
+
+# Keyword/signal scans, one pass per group over the lowercased body
+NICHE_TAGS = ["pet", "cat", "dog", "fitness", "gym", "beauty", "home", "kitchen", "outdoor", "camp", "tech", "gadget", "baby", "kids"]
+# Substring match like `tag in kw`, so "pets" and "camping" still count
+NICHE_RE = re.compile("|".join(map(re.escape, NICHE_TAGS)))
+DEMAND_RE = re.compile(r"add to cart|buy now|bestseller|sold")
+SUPPLIER_RE = re.compile(r"aliexpress|amazon|etsy|ebay")
+
+
+def ignore_sigint():
+    """Pool initializer: leave Ctrl-C to the server, which shuts the pool down."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _jsonld_price(blocks: List[str]) -> Optional[float]:
+    """Return the first offer price found in JSON-LD script blocks."""
+    pending = []
+    for raw in blocks:
+        try:
+            pending.append(json.loads(raw))
+        except (ValueError, RecursionError):
+            # Malformed, or nested deeper than the decoder can recurse
+            continue
+    while pending:
+        node = pending.pop(0)
+        if isinstance(node, list):
+            pending.extend(node)
+        elif isinstance(node, dict):
+            for key in ("price", "lowPrice"):
+                value = node.get(key)
+                if value is None or isinstance(value, bool):
+                    continue
+                try:
+                    price = float(value)
+                except (TypeError, ValueError):
+                    continue
+                # DSProduct.price is ge=0; NaN/inf/negatives would fail validation
+                if math.isfinite(price) and price >= 0:
+                    return price
+            pending.extend(v for v in node.values() if isinstance(v, (dict, list)))
+    return None
+
+
+def analyze_html_bytes(raw: bytes, encoding: str, url: str, domain: str) -> dict:
+    """Decode a fetched page and extract the DSProduct fields from it.
+
+    Pure CPU work with no shared state, so it can run in a worker process.
+    """
+    try:
+        html = raw.decode(encoding, errors="replace")
+    except LookupError:
+        html = raw.decode("utf-8", errors="replace")
+    kw = html.lower()
+    dom_lower = domain.lower()
+
+    title = None
+    images: Optional[List[str]] = None
+    price = None
+    try:
+        tree = lxml_html.fromstring(html)
+    except (ParserError, ValueError):
+        tree = None
+
+    if tree is not None:
+        # Title
+        raw_title = tree.xpath('string(//meta[@property="og:title"]/@content)') or tree.xpath('string(//title/text())')
+        if raw_title:
+            title = re.sub(r"\s+", " ", raw_title).strip()[:180] or None
+
+        # Image
+        mimg = tree.xpath('//meta[@property="og:image"]/@content')
+        if mimg:
+            images = list(dict.fromkeys(mimg))[:5]
+
+        # Price (structured data first)
+        price = _jsonld_price(tree.xpath('//script[@type="application/ld+json"]/text()'))
+    else:
+        # Fallback for markup lxml refuses to parse: one pass for og:title and og:image
+        meta = {"og:title": [], "og:image": []}
+        for m in META_RE.finditer(html):
+            meta[m.group(1).lower()].append(m.group("val"))
+        raw_title = meta["og:title"][0] if meta["og:title"] else None
+        if raw_title is None:
+            m = TITLE_RE.search(html)
+            raw_title = m.group(1) if m else None
+        if raw_title:
+            title = re.sub(r"\s+", " ", raw_title).strip()[:180]
+
+        if meta["og:image"]:
+            images = list(dict.fromkeys(meta["og:image"]))[:5]
+
+    # Price
+    if price is None:
+        mprice = PRICE_RE.search(html)
+        if mprice:
+            try:
+                price = float(mprice.group(1))
+            except:
+                price = None
+
+    # Currency heuristic
+    mcur = CURRENCY_RE.search(html)
+    currency = CURRENCY_MAP[mcur.group(0)] if mcur else None
+
+    # Source/platform
+    m = PLATFORM_RE.search(kw) or PLATFORM_RE.search(dom_lower)
+    source = m.group(0) if m else domain
+
+    # Simple niche tags
+    found = set(NICHE_RE.findall(kw))
+    tags: List[str] = [t for t in NICHE_TAGS if t in found][:6]
+
+    # Heuristic scoring
+    estimated_demand = len(DEMAND_RE.findall(kw)) * 10
+    supplier_count = len(SUPPLIER_RE.findall(kw))
+    score = max(10.0, min(95.0, 50 + (estimated_demand * 0.2) - (supplier_count * 5)))
+
+    return dict(
+        url=url,
+        title=title,
+        price=price,
+        currency=currency,
+        images=images,
+        source=source,
+        niche_tags=tags or None,
+        score=round(score, 1),
+        estimated_demand=estimated_demand,
+        supplier_count=supplier_count,
+    )
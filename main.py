@@ -1,16 +1,173 @@
 import os
-from fastapi import FastAPI, HTTPException, Query
+import asyncio
+import hashlib
+import multiprocessing
+import threading
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel, HttpUrl
-from typing import List, Optional
+from typing import List, Optional, Tuple
 import re
-import requests
+import httpx
+import orjson
 from urllib.parse import urlparse
+from cachetools import TTLCache, cached
 
-from database import db, create_document, get_documents
+from analysis import analyze_html_bytes, ignore_sigint
+from database import db, create_documents, get_documents
 from schemas import DSProduct
 
-app = FastAPI()
+logger = logging.getLogger(__name__)
+
+USER_AGENT = "Mozilla/5.0 (compatible; DropshipFinder/1.0)"
+
+# Shared outbound HTTP client, opened and closed with the app lifespan
+http_client: Optional[httpx.AsyncClient] = None
+
+CPU_COUNT = os.cpu_count() or 1
+# Number of uvicorn worker processes sharing this machine's cores. Unset means
+# a single process (plain `uvicorn main:app`, start_server.sh). uvicorn does not
+# expose its --workers count to the app, so multi-worker deployments must set
+# WEB_CONCURRENCY (run.py does) rather than pass --workers on its own.
+WEB_CONCURRENCY = max(1, int(os.getenv("WEB_CONCURRENCY", 1)))
+
+# Worker processes for HTML parsing, kept off the event loop thread
+process_pool: Optional[ProcessPoolExecutor] = None
+
+# Set once the dsproduct text index exists; /discover uses $regex until then
+text_index_ready = False
+
+# Analyzed products waiting to be written to Mongo in batches
+INSERT_BATCH_SIZE = 64
+INSERT_MAX_WAIT = 0.05
+# Caps memory when Mongo is slow or down; analyses past this are dropped
+INSERT_QUEUE_MAX = 10_000
+# How long shutdown waits for queued inserts before giving up on them
+INSERT_SHUTDOWN_TIMEOUT = 10.0
+insert_queue: Optional[asyncio.Queue] = None
+_STOP_INSERTS = object()
+
+
+def _flush_inserts(batch: List[dict]):
+    try:
+        create_documents("dsproduct", batch)
+    except Exception:
+        pass
+
+
+def _ensure_indexes():
+    """Create the indexes /discover relies on (no-op if they already exist).
+
+    Runs in the background so an unreachable Mongo can't hold up startup.
+    """
+    global text_index_ready
+    if db is None:
+        return
+    # $text inside $or needs every clause indexed, so both must succeed
+    try:
+        db["dsproduct"].create_index("niche_tags")
+        db["dsproduct"].create_index([("title", "text"), ("source", "text"), ("niche_tags", "text")])
+    except Exception as e:
+        # e.g. IndexOptionsConflict from an existing text index with another spec
+        logger.error("Could not create dsproduct indexes, /discover will use regex matching: %s", e)
+        return
+    text_index_ready = True
+
+
+async def _insert_worker():
+    """Drain insert_queue, writing up to INSERT_BATCH_SIZE docs per round trip.
+
+    Returns after flushing everything queued ahead of _STOP_INSERTS.
+    """
+    loop = asyncio.get_running_loop()
+    stopping = False
+    while not stopping:
+        item = await insert_queue.get()
+        if item is _STOP_INSERTS:
+            break
+        batch = [item]
+        deadline = loop.time() + INSERT_MAX_WAIT
+        while len(batch) < INSERT_BATCH_SIZE:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(insert_queue.get(), remaining)
+            except asyncio.TimeoutError:
+                break
+            if item is _STOP_INSERTS:
+                stopping = True
+                break
+            batch.append(item)
+        await asyncio.to_thread(_flush_inserts, batch)
+
+
+def _new_process_pool() -> ProcessPoolExecutor:
+    # spawn, not fork: the parent already holds a MongoClient and worker threads.
+    # Spawned children import `analysis` plus the launching script as __mp_main__,
+    # which is why the launcher lives in run.py and imports nothing heavy.
+    # Cores are shared between the uvicorn workers so N workers don't spawn N*cpu parsers.
+    return ProcessPoolExecutor(
+        max_workers=max(1, CPU_COUNT // WEB_CONCURRENCY),
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=ignore_sigint,
+    )
+
+
+async def _stop_insert_worker(writer: asyncio.Task):
+    """Queue the stop marker behind pending items and wait for the writer."""
+    await insert_queue.put(_STOP_INSERTS)
+    await writer
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global http_client, insert_queue, process_pool
+    # Held for the app's lifetime so the task isn't garbage collected mid-run
+    app.state.index_task = asyncio.create_task(asyncio.to_thread(_ensure_indexes))
+    process_pool = _new_process_pool()
+    insert_queue = asyncio.Queue(maxsize=INSERT_QUEUE_MAX)
+    writer = asyncio.create_task(_insert_worker())
+    # Keep-alive pool sized for repeat hits on the same shops; retries cover
+    # connection setup failures only, never a request that was already sent
+    transport = httpx.AsyncHTTPTransport(
+        retries=2,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=64, keepalive_expiry=30.0),
+    )
+    http_client = httpx.AsyncClient(
+        transport=transport,
+        timeout=8.0,
+        headers={"User-Agent": USER_AGENT},
+        follow_redirects=True,
+    )
+    try:
+        yield
+    finally:
+        try:
+            # Let the writer flush its in-progress batch and the rest of the
+            # queue, but don't hang shutdown on an unreachable Mongo
+            await asyncio.wait_for(_stop_insert_worker(writer), INSERT_SHUTDOWN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.error(
+                "Gave up on dsproduct inserts at shutdown; %d still queued plus the batch in flight",
+                insert_queue.qsize(),
+            )
+        finally:
+            writer.cancel()
+            try:
+                process_pool.shutdown(wait=False, cancel_futures=True)
+                process_pool = None
+            finally:
+                await http_client.aclose()
+                http_client = None
+
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -31,6 +188,12 @@ class SearchRequest(BaseModel):
 def read_root():
     return {"message": "Dropship Finder API"}
 
+# /test runs in the threadpool, hence the lock. Errors propagate without
+# being stored, so the next call after a failure queries Mongo again.
+@cached(cache=TTLCache(maxsize=1, ttl=30), lock=threading.Lock())
+def _collection_names() -> List[str]:
+    return db.list_collection_names()
+
 @app.get("/test")
 def test_database():
     """Test endpoint to check if database is available and accessible"""
@@ -49,7 +212,7 @@ def test_database():
             response["database_name"] = db.name if hasattr(db, 'name') else "✅ Connected"
             response["connection_status"] = "Connected"
             try:
-                collections = db.list_collection_names()
+                collections = _collection_names()
                 response["collections"] = collections[:10]
                 response["database"] = "✅ Connected & Working"
             except Exception as e:
@@ -63,135 +226,132 @@ def test_database():
     response["database_name"] = "✅ Set" if os.getenv("DATABASE_NAME") else "❌ Not Set"
     return response
 
-# Basic HTML parser helpers
-TITLE_RE = re.compile(r"<title>(.*?)</title>", re.IGNORECASE | re.DOTALL)
-META_TITLE_RE = re.compile(r'<meta[^>]*property=["\']og:title["\'][^>]*content=["\'](.*?)["\']', re.IGNORECASE)
-META_IMG_RE = re.compile(r'<meta[^>]*property=["\']og:image["\'][^>]*content=["\'](.*?)["\']', re.IGNORECASE)
-PRICE_RE = re.compile(r"(?:price|amount)\"?[:=]\"?\s*([0-9]+(?:\.[0-9]{2})?)", re.IGNORECASE)
+# Signals live in <head> and the first screen of markup; skip the rest
+MAX_HTML_BYTES = 512 * 1024
+# Declared sizes above this are refused without reading any of the body
+MAX_CONTENT_LENGTH = 2_000_000
 
-COMMON_SHOP_PLATFORMS = ["shopify", "woocommerce", "magento", "bigcommerce", "aliexpress", "amazon"]
+# Recent /analyze results keyed by URL without fragment. Only touched from
+# the event loop thread, so no lock is needed around get/set.
+ANALYSIS_CACHE: TTLCache = TTLCache(maxsize=2048, ttl=600)
 
-
-@app.post("/analyze", response_model=DSProduct)
-def analyze_product(req: AnalyzeRequest):
-    """Fetch basic signals from a product URL and score it heuristically."""
-    url = str(req.url)
+async def _fetch_page(url: str) -> Tuple[bytes, str]:
+    """Stream a page, returning at most MAX_HTML_BYTES of it and its charset."""
     try:
-        resp = requests.get(url, timeout=8, headers={
-            "User-Agent": "Mozilla/5.0 (compatible; DropshipFinder/1.0)"
-        })
+        async with http_client.stream("GET", url) as resp:
+            if resp.status_code >= 400:
+                raise HTTPException(status_code=400, detail=f"Bad response: {resp.status_code}")
+            content_type = resp.headers.get("content-type", "").lower()
+            if content_type and "html" not in content_type:
+                raise HTTPException(status_code=415, detail=f"Unsupported content type: {content_type[:50]}")
+            try:
+                content_length = int(resp.headers.get("content-length", 0))
+            except ValueError:
+                content_length = 0
+            if content_length > MAX_CONTENT_LENGTH:
+                raise HTTPException(status_code=413, detail=f"Page too large: {content_length} bytes")
+            raw = bytearray()
+            async for chunk in resp.aiter_bytes():
+                raw += chunk
+                if len(raw) >= MAX_HTML_BYTES:
+                    break
+            encoding = resp.encoding or "utf-8"
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Failed to fetch URL: {e}")
 
-    if resp.status_code >= 400:
-        raise HTTPException(status_code=400, detail=f"Bad response: {resp.status_code}")
-
-    html = resp.text
+    return bytes(raw[:MAX_HTML_BYTES]), encoding
 
-    # Title
-    title = None
-    m = META_TITLE_RE.search(html) or TITLE_RE.search(html)
-    if m:
-        title = re.sub(r"\s+", " ", m.group(1)).strip()[:180]
 
-    # Image
-    images: Optional[List[str]] = None
-    mimg = META_IMG_RE.findall(html)
-    if mimg:
-        images = list(dict.fromkeys(mimg))[:5]
-
-    # Price
-    price = None
-    mprice = PRICE_RE.search(html)
-    if mprice:
-        try:
-            price = float(mprice.group(1))
-        except:
-            price = None
-
-    # Currency heuristic
-    currency = None
-    if "$" in html:
-        currency = "USD"
-    elif "€" in html:
-        currency = "EUR"
-    elif "£" in html:
-        currency = "GBP"
-
-    # Source/platform
-    domain = urlparse(url).netloc
-    source = domain
-    for p in COMMON_SHOP_PLATFORMS:
-        if p in html.lower() or p in domain.lower():
-            source = p
-            break
+@app.post("/analyze", response_model=DSProduct)
+async def analyze_product(req: AnalyzeRequest):
+    """Fetch basic signals from a product URL and score it heuristically."""
+    url = str(req.url)
+    parsed = urlparse(url)
+    key = parsed._replace(fragment="").geturl()
+    hit = ANALYSIS_CACHE.get(key)
+    if hit is not None:
+        return hit
 
-    # Simple niche tags
-    tags: List[str] = []
-    kw = html.lower()
-    for t in ["pet", "cat", "dog", "fitness", "gym", "beauty", "home", "kitchen", "outdoor", "camp", "tech", "gadget", "baby", "kids"]:
-        if t in kw:
-            tags.append(t)
-    tags = list(dict.fromkeys(tags))[:6]
-
-    # Heuristic scoring
-    estimated_demand = len(re.findall(r"add to cart|buy now|bestseller|sold", kw)) * 10
-    supplier_count = len(re.findall(r"aliexpress|amazon|etsy|ebay", kw))
-    score = max(10.0, min(95.0, 50 + (estimated_demand * 0.2) - (supplier_count * 5)))
-
-    data = DSProduct(
-        url=url,
-        title=title,
-        price=price,
-        currency=currency,
-        images=images,
-        source=source,
-        niche_tags=tags or None,
-        score=round(score, 1),
-        estimated_demand=estimated_demand,
-        supplier_count=supplier_count,
-    )
+    raw, encoding = await _fetch_page(url)
+    global process_pool
+    pool = process_pool
+    loop = asyncio.get_running_loop()
+    try:
+        fields = await loop.run_in_executor(pool, analyze_html_bytes, raw, encoding, url, parsed.netloc)
+    except BrokenProcessPool:
+        # A parser process died; swap in a fresh pool (once, even if several
+        # requests notice together) so later calls don't keep failing
+        if process_pool is pool:
+            logger.error("HTML parsing pool broke, starting a new one")
+            process_pool = _new_process_pool()
+            pool.shutdown(wait=False, cancel_futures=True)
+        raise HTTPException(status_code=503, detail="Analyzer temporarily unavailable, please retry")
+    data = DSProduct(**fields)
+    ANALYSIS_CACHE[key] = data
 
     try:
-        create_document("dsproduct", data)
-    except Exception:
-        pass
+        insert_queue.put_nowait(data.model_dump())
+    except asyncio.QueueFull:
+        logger.warning("Insert queue full, not storing analysis of %s", url)
 
     return data
 
 
+DISCOVER_PROJECTION = {"_id": 0, **{field: 1 for field in DSProduct.model_fields}}
+DISCOVER_MAX_AGE = 30
+# (q, limit) -> (serialized body, ETag)
+DISCOVER_CACHE: TTLCache = TTLCache(maxsize=256, ttl=DISCOVER_MAX_AGE)
+
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Weak comparison of an If-None-Match header against our ETag."""
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*":
+            return True
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+
 @app.get("/discover", response_model=List[DSProduct])
-def discover_products(q: str = Query("pet", max_length=40), limit: int = Query(8, ge=1, le=24)):
+async def discover_products(request: Request, q: str = Query("pet", max_length=40), limit: int = Query(8, ge=1, le=24)):
     """Return recently analyzed items matching a simple tag or domain filter."""
-    flt = {}
-    if q:
-        flt = {"$or": [
-            {"niche_tags": {"$regex": q, "$options": "i"}},
-            {"source": {"$regex": q, "$options": "i"}},
-            {"title": {"$regex": q, "$options": "i"}},
-        ]}
-    try:
-        docs = get_documents("dsproduct", flt, limit)
-    except Exception:
-        docs = []
-    out: List[DSProduct] = []
-    for d in docs:
-        out.append(DSProduct(
-            url=d.get("url"),
-            title=d.get("title"),
-            price=d.get("price"),
-            currency=d.get("currency"),
-            images=d.get("images"),
-            source=d.get("source"),
-            niche_tags=d.get("niche_tags"),
-            score=d.get("score"),
-            estimated_demand=d.get("estimated_demand"),
-            supplier_count=d.get("supplier_count"),
-        ))
-    return out
-
-
-if __name__ == "__main__":
-    import uvicorn
-    port = int(os.getenv("PORT", 8000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    key = (q, limit)
+    hit = DISCOVER_CACHE.get(key)
+    if hit is None:
+        flt = {}
+        if q and text_index_ready:
+            flt = {"$or": [
+                {"niche_tags": q.lower()},
+                {"$text": {"$search": q}},
+            ]}
+        elif q:
+            pattern = re.escape(q)
+            flt = {"$or": [
+                {"niche_tags": {"$regex": pattern, "$options": "i"}},
+                {"source": {"$regex": pattern, "$options": "i"}},
+                {"title": {"$regex": pattern, "$options": "i"}},
+            ]}
+        try:
+            docs = await asyncio.to_thread(get_documents, "dsproduct", flt, limit, DISCOVER_PROJECTION)
+        except Exception:
+            # Don't let clients or proxies hold on to an outage result
+            return Response(content=b"[]", media_type="application/json", headers={"Cache-Control": "no-store"})
+        # Rows were validated on the way in; serialize the projected docs as-is
+        # instead of rebuilding and re-checking a DSProduct per row
+        body = orjson.dumps([{k: d.get(k) for k in DSProduct.model_fields} for d in docs])
+        hit = (body, f'"{hashlib.sha1(body).hexdigest()}"')
+        DISCOVER_CACHE[key] = hit
+
+    body, etag = hit
+    headers = {"ETag": etag, "Cache-Control": f"public, max-age={DISCOVER_MAX_AGE}"}
+    if _etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
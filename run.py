@@ -0,0 +1,25 @@
+"""
+Server launcher
+
+Kept separate from main.py: the HTML parsing pool uses spawn, and spawned
+children re-import this script as __mp_main__. Importing only uvicorn here
+keeps them from loading FastAPI, the database client and the app.
+"""
+
+import os
+
+import uvicorn
+
+if __name__ == "__main__":
+    port = int(os.getenv("PORT", 8000))
+    workers = max(1, int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1)))
+    # Worker processes re-import main; tell them how many siblings share the cores
+    os.environ["WEB_CONCURRENCY"] = str(workers)
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=port,
+        workers=workers,
+        loop="uvloop",
+        http="httptools",
+    )